@@ -8,171 +8,373 @@ import tempfile
 from pathlib import Path
 import io
 import concurrent.futures
-from typing import List, Tuple
+import threading
+from typing import List, Tuple, Union
 import numpy as np
+from zipstream import ZipStream
+
+# GPU JPEG encoding via nvJPEG. Batched encode_jpeg on CUDA tensors needs
+# torchvision >= 0.19, older releases fall back to the CPU encoders.
+try:
+    import torch
+    import torchvision
+    from torchvision.io import encode_jpeg
+    torchvision_version = tuple(int(part) for part in torchvision.__version__.split('.')[:2])
+    GPU_JPEG = torch.cuda.is_available() and torchvision_version >= (0, 19)
+except ImportError:
+    GPU_JPEG = False
+
+# libjpeg-turbo SIMD encoder, OpenCV is used when the library is not installed
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420
+    TJ = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    TJ = None
 
 app = fastapi.FastAPI()
 
 # Thread pool for CPU-intensive operations
 executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
 
-def process_frame_batch(frames: List[Tuple[int, np.ndarray]], quality: int, compression_level: int = 6) -> List[Tuple[str, bytes]]:
-    """Process a batch of frames in parallel"""
-    results = []
-    encode_params = [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_OPTIMIZE, 1]
-    
-    for frame_idx, frame in frames:
-        # Encode frame to JPEG
-        _, buffer = cv2.imencode('.jpg', frame, encode_params)
-        filename = f"frame_{frame_idx:06d}.jpg"
-        results.append((filename, buffer.tobytes()))
-    
-    return results
+# Encode stages per streaming request, next to one decode stage. The response
+# generator itself writes the zip on the event loop.
+ENCODE_WORKERS = 2
 
-async def extract_frames_streaming(video_data: bytes, quality: int = 70, skip_frames: int = 1):
-    """Extract frames and stream zip directly without disk storage"""
-    
-    # Create in-memory buffer for zip
-    zip_buffer = io.BytesIO()
+# Uploads are copied to disk in chunks of this size instead of read whole
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Per-thread output buffers TurboJPEG encodes into, so encoding a frame does
+# not allocate and free a worst-case sized JPEG buffer every time
+encode_buffers = threading.local()
+
+# Encoded frame data, memoryviews wrap encoder output without copying it
+FrameData = Union[bytes, memoryview]
+
+# Frame formats clients can ask for, with the OpenCV quality flag for each.
+# WebP is noticeably smaller than JPEG for bandwidth-bound clients.
+IMAGE_FORMATS = {
+    'jpg': cv2.IMWRITE_JPEG_QUALITY,
+    'webp': cv2.IMWRITE_WEBP_QUALITY,
+}
+
+def open_video(path: str) -> cv2.VideoCapture:
+    """Open a video with FFmpeg, decoding on the GPU (NVDEC, VA-API, ...) when one is available"""
+    return cv2.VideoCapture(path, cv2.CAP_FFMPEG, [
+        cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY
+    ])
+
+def frame_filenames(start: int, count: int, image_format: str) -> List[str]:
+    """Build the zip entry names for a run of frames in one go"""
+    name_format = f"frame_%06d.{image_format}"
+    return [name_format % i for i in range(start, start + count)]
+
+def encode_batch_gpu(frames: List[np.ndarray], filenames: List[str], quality: int) -> List[Tuple[str, FrameData]]:
+    """Encode a whole batch of frames with nvJPEG in a single call"""
+    stream = torch.cuda.Stream()
+    with torch.cuda.stream(stream):
+        # Upload BGR frames and convert to CHW RGB on the device
+        images = [
+            torch.from_numpy(frame).pin_memory().cuda(non_blocking=True).flip(-1).permute(2, 0, 1).contiguous()
+            for frame in frames
+        ]
+        encoded = encode_jpeg(images, quality=quality)
+        encoded = [data.to('cpu', non_blocking=True) for data in encoded]
+    stream.synchronize()
+
+    return [(filename, memoryview(data.numpy())) for filename, data in zip(filenames, encoded)]
+
+def check_image_format(image_format: str):
+    """Reject output formats we cannot encode"""
+    if image_format not in IMAGE_FORMATS:
+        raise fastapi.HTTPException(
+            status_code=400,
+            detail=f"Unsupported format '{image_format}', expected one of: {', '.join(IMAGE_FORMATS)}"
+        )
+
+def jpeg_output_buffer(frame: np.ndarray) -> np.ndarray:
+    """Return this thread's reusable JPEG output buffer, grown to fit the frame"""
+    required_size = TJ.buffer_size(frame, TJSAMP_420)
+    buffer = getattr(encode_buffers, 'jpeg', None)
+    if buffer is None or buffer.nbytes < required_size:
+        buffer = encode_buffers.jpeg = np.empty(required_size, dtype=np.uint8)
+    return buffer
+
+def encode_frame(frame: np.ndarray, quality: int, image_format: str = 'jpg') -> FrameData:
+    """Encode a single BGR frame on the CPU"""
+    if image_format == 'jpg' and TJ is not None:
+        buffer, size = TJ.encode(
+            frame, quality=quality, pixel_format=TJPF_BGR, jpeg_subsample=TJSAMP_420,
+            dst=jpeg_output_buffer(frame)
+        )
+        # The buffer is reused for the next frame, so copy out just the JPEG
+        return buffer[:size].tobytes()
+
+    _, buffer = cv2.imencode(f'.{image_format}', frame, [IMAGE_FORMATS[image_format], quality])
+    return memoryview(buffer).cast('B')
+
+def process_frame_batch(frames: List[np.ndarray], filenames: List[str], quality: int, image_format: str = 'jpg') -> List[Tuple[str, FrameData]]:
+    """Process a batch of frames in parallel, filenames are built by the caller"""
+    if GPU_JPEG and image_format == 'jpg':
+        return encode_batch_gpu(frames, filenames, quality)
+
+    return [
+        (filename, encode_frame(frame, quality, image_format))
+        for filename, frame in zip(filenames, frames)
+    ]
+
+def read_frame_batch(cap: cv2.VideoCapture, skip_frames: int, batch_size: int) -> List[np.ndarray]:
+    """Decode the next batch of kept frames"""
+    frame_batch = []
+
+    while len(frame_batch) < batch_size:
+        ret, frame = cap.read()
+        if not ret:
+            break
+
+        frame_batch.append(frame)
+
+        # Skip frames if specified, grab() avoids the BGR conversion of read()
+        for _ in range(skip_frames):
+            if not cap.grab():
+                break
+
+    return frame_batch
+
+async def save_upload(file: fastapi.UploadFile) -> str:
+    """Stream an upload to a temporary file in fixed-size chunks, returns its path"""
+    with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as temp_video:
+        try:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                temp_video.write(chunk)
+        except BaseException:
+            temp_video.close()
+            Path(temp_video.name).unlink()
+            raise
+        return temp_video.name
+
+class VideoSource:
+    """
+    Capture on an uploaded temp file, decoded in the thread pool.
+
+    Cancelling a task that awaits a pool job does not stop the worker thread,
+    so the capture is only released once no read is running on it.
+    """
+
+    def __init__(self, cap: cv2.VideoCapture, temp_video_path: str):
+        self.cap = cap
+        self.temp_video_path = temp_video_path
+        self.reading = None  # concurrent.futures.Future of the current read
+        self.closed = False
+
+    async def read_batch(self, skip_frames: int, batch_size: int) -> List[np.ndarray]:
+        """Decode the next batch of kept frames, empty once closed"""
+        if self.closed:
+            return []
+        self.reading = executor.submit(read_frame_batch, self.cap, skip_frames, batch_size)
+        return await asyncio.wrap_future(self.reading)
+
+    def close(self):
+        """Release the capture and delete the temp file, after any in-flight read"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.reading is not None:
+            # Runs right away if the read is done, else on its worker thread
+            self.reading.add_done_callback(lambda _: self.release())
+        else:
+            self.release()
+
+    def release(self):
+        self.cap.release()
+        Path(self.temp_video_path).unlink(missing_ok=True)
+
+class ClosingStreamingResponse(StreamingResponse):
+    """StreamingResponse that always calls on_close, also when the body never started or was cancelled"""
+
+    def __init__(self, *args, on_close, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.on_close()
+
+async def open_uploaded_video(file: fastapi.UploadFile) -> VideoSource:
+    """Save the upload and open it for decoding"""
     
     # Write video data to temporary file (unavoidable for OpenCV)
-    with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as temp_video:
-        temp_video.write(video_data)
-        temp_video_path = temp_video.name
+    temp_video_path = await save_upload(file)
     
-    try:
-        cap = cv2.VideoCapture(temp_video_path)
-        if not cap.isOpened():
-            raise fastapi.HTTPException(status_code=400, detail="Could not open video file")
+    cap = open_video(temp_video_path)
+    if not cap.isOpened():
+        cap.release()
+        Path(temp_video_path).unlink(missing_ok=True)
+        raise fastapi.HTTPException(status_code=400, detail="Could not open video file")
 
+    return VideoSource(cap, temp_video_path)
+
+async def generate_frames_zip(source: VideoSource, quality: int, skip_frames: int, image_format: str):
+    """Yield zip data as frames are encoded, without buffering the whole archive"""
+    cap = source.cap
+    try:
         # Get video properties
         fps = cap.get(cv2.CAP_PROP_FPS)
         total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
         width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
         height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
-        # Create zip file in memory with faster compression
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=6) as zipf:
-            
-            frame_idx = 0
-            extracted_count = 0
-            frame_batch = []
-            batch_size = 50  # Process frames in batches
-            
-            while True:
-                ret, frame = cap.read()
-                if not ret:
-                    break
-                
-                # Skip frames if specified (reduces processing time)
-                if frame_idx % (skip_frames + 1) == 0:
-                    frame_batch.append((extracted_count, frame))
-                    extracted_count += 1
-                    
-                    # Process batch when it's full
-                    if len(frame_batch) >= batch_size:
-                        # Process batch in thread pool
-                        loop = asyncio.get_event_loop()
-                        processed_frames = await loop.run_in_executor(
-                            executor, process_frame_batch, frame_batch, quality
-                        )
-                        
-                        # Add to zip
-                        for filename, frame_data in processed_frames:
-                            zipf.writestr(filename, frame_data)
-                        
-                        frame_batch = []
-                
-                frame_idx += 1
-            
-            # Process remaining frames
-            if frame_batch:
-                loop = asyncio.get_event_loop()
-                processed_frames = await loop.run_in_executor(
-                    executor, process_frame_batch, frame_batch, quality
-                )
-                for filename, frame_data in processed_frames:
-                    zipf.writestr(filename, frame_data)
-
-            # Create optimized metadata
-            metadata = {
-                "fps": fps,
-                "total_frames": total_frames,
-                "extracted_frames": extracted_count,
-                "width": width,
-                "height": height,
-                "skip_frames": skip_frames
-            }
-            
-            # Add metadata to zip
-            zipf.writestr("metadata.json", json.dumps(metadata, separators=(',', ':')))
+        # Encoded frames are already compressed, so store them as-is
+        zs = ZipStream(compress_type=zipfile.ZIP_STORED, sized=False)
+        
+        loop = asyncio.get_event_loop()
+        batch_size = 25  # Process frames in batches
+        extracted_count = 0
 
-        cap.release()
+        # Decode -> encode -> zip stages connected by bounded queues so the
+        # decoder, the JPEG encoders and the zip output all run concurrently
+        decode_q = asyncio.Queue(maxsize=2)
+        zip_q = asyncio.Queue(maxsize=ENCODE_WORKERS)
+        # A slot is held from decoding a batch until it is zipped: one per
+        # encoder, one for the batch being decoded and one queued. A request so
+        # holds at most (ENCODE_WORKERS + 2) * batch_size decoded frames, 100
+        # with the defaults, and the reorder buffer stays bounded.
+        in_flight = asyncio.Semaphore(ENCODE_WORKERS + 2)
+
+        async def decode():
+            nonlocal extracted_count
+            batch_seq = 0
+            try:
+                while True:
+                    await in_flight.acquire()
+                    frame_batch = await source.read_batch(skip_frames, batch_size)
+                    if not frame_batch:
+                        in_flight.release()
+                        break
+                    filenames = frame_filenames(extracted_count, len(frame_batch), image_format)
+                    extracted_count += len(frame_batch)
+                    # Tag batches with their sequence number to restore order after encoding
+                    await decode_q.put((batch_seq, frame_batch, filenames))
+                    batch_seq += 1
+            except Exception:
+                # Still stop the encoders so the error reaches the consumer
+                for _ in range(ENCODE_WORKERS):
+                    await decode_q.put(None)
+                raise
+
+            for _ in range(ENCODE_WORKERS):
+                await decode_q.put(None)
+
+        async def encode():
+            try:
+                while (item := await decode_q.get()) is not None:
+                    batch_seq, frame_batch, filenames = item
+                    processed_frames = await loop.run_in_executor(
+                        executor, process_frame_batch, frame_batch, filenames, quality, image_format
+                    )
+                    # Free the decoded frames now, the pool thread may still
+                    # hold a reference to the batch for a moment
+                    frame_batch.clear()
+                    await zip_q.put((batch_seq, processed_frames))
+            except Exception as e:
+                # A missing batch would stall the reorder buffer, so hand the
+                # error to the consumer, which stops the whole pipeline
+                await zip_q.put(e)
+                return
+
+            await zip_q.put(None)
+
+        decoder = asyncio.ensure_future(decode())
+        encoders = [asyncio.ensure_future(encode()) for _ in range(ENCODE_WORKERS)]
+        try:
+            # This generator is the single zip writer. Encoders can finish
+            # batches out of order, so hold early ones until their turn.
+            finished = 0
+            next_seq = 0
+            reorder = {}
+            while finished < ENCODE_WORKERS:
+                item = await zip_q.get()
+                if item is None:
+                    finished += 1
+                    continue
+                if isinstance(item, Exception):
+                    raise item
+                batch_seq, processed_frames = item
+                reorder[batch_seq] = processed_frames
+                while next_seq in reorder:
+                    for filename, frame_data in reorder.pop(next_seq):
+                        # ZipStream only takes bytes or iterables, so wrap views in a list
+                        zs.add([frame_data], filename, size=len(frame_data))
+                    next_seq += 1
+                    in_flight.release()
+                for chunk in zs.all_files():
+                    yield chunk
+
+            # Surface errors from any stage before writing the metadata
+            await asyncio.gather(*encoders)
+            await decoder
+        finally:
+            for stage in (decoder, *encoders):
+                stage.cancel()
+
+        # Create optimized metadata
+        metadata = {
+            "fps": fps,
+            "total_frames": total_frames,
+            "extracted_frames": extracted_count,
+            "width": width,
+            "height": height,
+            "skip_frames": skip_frames,
+            "format": image_format
+        }
+        
+        # Add metadata to zip, the only entry worth compressing
+        zs.add(
+            json.dumps(metadata, separators=(',', ':')), "metadata.json",
+            compress_type=zipfile.ZIP_DEFLATED, compress_level=6
+        )
+        for chunk in zs.finalize():
+            yield chunk
         
     finally:
-        # Clean up temp video file
-        try:
-            Path(temp_video_path).unlink()
-        except:
-            pass
-    
-    # Reset buffer position for reading
-    zip_buffer.seek(0)
-    return zip_buffer
+        source.close()
 
 @app.post("/extract_frames/")
 async def extract_frames_zip(
     file: fastapi.UploadFile,
     quality: int = 70,  # Reduced default quality for speed
-    skip_frames: int = 0  # Skip every N frames (0 = extract all)
+    skip_frames: int = 0,  # Skip every N frames (0 = extract all)
+    format: str = 'jpg'  # Frame image format (jpg or webp)
 ):
     """
     Extract frames from video and return as streaming zip
     
     Args:
         file: Video file
-        quality: JPEG quality (1-100, lower = faster)
+        quality: Image quality (1-100, lower = faster)
         skip_frames: Skip every N frames (0 = all frames, 1 = every other frame, etc.)
+        format: Frame image format, "jpg" (default) or "webp" for smaller downloads
     """
-    # Read file data once
-    video_data = await file.read()
+    check_image_format(format)
     
-    # Generate zip stream
-    zip_buffer = await extract_frames_streaming(video_data, quality, skip_frames)
-    
-    # Stream the zip file directly
-    def generate():
-        while True:
-            chunk = zip_buffer.read(8192)  # 8KB chunks
-            if not chunk:
-                break
-            yield chunk
+    source = await open_uploaded_video(file)
     
     filename = f"{Path(file.filename).stem}_frames.zip"
     
-    return StreamingResponse(
-        generate(),
+    # Stream the zip file directly, frames go out as they are encoded. The
+    # response closes the source even if the generator never got to run.
+    return ClosingStreamingResponse(
+        generate_frames_zip(source, quality, skip_frames, format),
+        on_close=source.close,
         media_type="application/zip",
         headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
 
-@app.post("/extract_frames_fast/")
-async def extract_frames_fast(
-    file: fastapi.UploadFile,
-    max_frames: int = 100,  # Limit number of frames
-    quality: int = 60       # Lower quality for speed
-):
-    """
-    Ultra-fast frame extraction with limits for mobile apps
-    """
-    video_data = await file.read()
-    
-    with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as temp_video:
-        temp_video.write(video_data)
-        temp_video_path = temp_video.name
-    
+def build_fast_zip(temp_video_path: str, max_frames: int, quality: int, image_format: str = 'jpg') -> io.BytesIO:
+    """Extract up to max_frames evenly spaced frames into an in-memory zip"""
     try:
-        cap = cv2.VideoCapture(temp_video_path)
+        cap = open_video(temp_video_path)
         if not cap.isOpened():
             raise fastapi.HTTPException(status_code=400, detail="Could not open video file")
 
@@ -184,27 +386,24 @@ async def extract_frames_fast(
         
         zip_buffer = io.BytesIO()
         extracted_count = 0
+        filenames = []
         
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zipf:
-            frame_idx = 0
-            
-            while True:
+        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_STORED) as zipf:
+            while extracted_count < max_frames:
                 ret, frame = cap.read()
-                if not ret or extracted_count >= max_frames:
+                if not ret:
                     break
                 
-                if frame_idx % skip_factor == 0:
-                    # Quick JPEG encoding with minimal quality
-                    _, buffer = cv2.imencode('.jpg', frame, [
-                        cv2.IMWRITE_JPEG_QUALITY, quality,
-                        cv2.IMWRITE_JPEG_OPTIMIZE, 0  # Disable optimization for speed
-                    ])
-                    
-                    filename = f"frame_{extracted_count:04d}.jpg"
-                    zipf.writestr(filename, buffer.tobytes())
-                    extracted_count += 1
+                # Quick encoding with minimal quality
+                filename = f"frame_{extracted_count:04d}.{image_format}"
+                filenames.append(filename)
+                zipf.writestr(filename, encode_frame(frame, quality, image_format))
+                extracted_count += 1
                 
-                frame_idx += 1
+                # Step over the frames in between without converting them to BGR
+                for _ in range(skip_factor - 1):
+                    if not cap.grab():
+                        break
             
             # Keep exact same metadata format as original
             metadata = {
@@ -217,12 +416,15 @@ async def extract_frames_fast(
                     {
                         "frame_index": i,
                         "timestamp": (i * skip_factor) / fps if fps > 0 else 0.0,
-                        "filename": f"frame_{i:04d}.jpg"
+                        "filename": filename
                     }
-                    for i in range(extracted_count)
+                    for i, filename in enumerate(filenames)
                 ]
             }
-            zipf.writestr("metadata.json", json.dumps(metadata, separators=(',', ':')))
+            zipf.writestr(
+                "metadata.json", json.dumps(metadata, separators=(',', ':')),
+                compress_type=zipfile.ZIP_DEFLATED, compresslevel=1
+            )
 
         cap.release()
         
@@ -233,6 +435,25 @@ async def extract_frames_fast(
             pass
     
     zip_buffer.seek(0)
+    return zip_buffer
+
+@app.post("/extract_frames_fast/")
+async def extract_frames_fast(
+    file: fastapi.UploadFile,
+    max_frames: int = 100,  # Limit number of frames
+    quality: int = 60,      # Lower quality for speed
+    format: str = 'jpg'     # Frame image format (jpg or webp)
+):
+    """
+    Ultra-fast frame extraction with limits for mobile apps
+    """
+    check_image_format(format)
+    temp_video_path = await save_upload(file)
+    
+    # Build the zip in the thread pool so the event loop keeps serving
+    zip_buffer = await asyncio.get_event_loop().run_in_executor(
+        executor, build_fast_zip, temp_video_path, max_frames, quality, format
+    )
     
     def generate():
         while True:
@@ -0,0 +1,44 @@
+import asyncio
+
+import cv2
+import numpy as np
+import pytest
+
+import server2
+
+
+def write_video(path, frame_count=600):
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'mp4v'), 30, (64, 48))
+    for i in range(frame_count):
+        writer.write(np.full((48, 64, 3), i % 256, dtype=np.uint8))
+    writer.release()
+
+
+async def drain(stream):
+    async for _ in stream:
+        pass
+
+
+def test_encoder_failure_stops_the_stream(tmp_path, monkeypatch):
+    """An encoder error must reach the response instead of stalling the pipeline"""
+    video_path = tmp_path / "video.mp4"
+    write_video(video_path)
+
+    # Fail only the second batch, the other encoder keeps going past it and
+    # there are more batches left than fit in flight
+    process_frame_batch = server2.process_frame_batch
+    first_frame = server2.frame_filenames(0, 1, 'jpg')[0]
+    failed = []
+
+    def fail_second_batch(frames, filenames, quality, image_format):
+        if filenames[0] != first_frame and not failed:
+            failed.append(filenames[0])
+            raise RuntimeError("encode failed")
+        return process_frame_batch(frames, filenames, quality, image_format)
+
+    monkeypatch.setattr(server2, "process_frame_batch", fail_second_batch)
+
+    source = server2.VideoSource(server2.open_video(str(video_path)), str(video_path))
+    stream = server2.generate_frames_zip(source, 70, 0, 'jpg')
+    with pytest.raises(RuntimeError, match="encode failed"):
+        asyncio.run(asyncio.wait_for(drain(stream), timeout=30))